@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""Checks that every turnout engine gives exactly the same numbers as generate_key.py, and that none got slower or uses more memory.
+Each engine parses the same generated fixture counties for every election year in ELECTION_DAY.
+Its per-county age histograms and its own key.json must be identical to the reference engine, including the quirks:
+negative fractional ages from get_age, unregistered voters promoted when their vote is found,
+and active voters with no registration date counted as registered.
+Runtime and peak memory of each engine are compared against BASELINE_FILE. Baselines are local to each machine and not committed;
+the first run of an engine on a machine records its baseline, and --update-baselines re-records all of them.
+Usage: ./check_engines.py [--update-baselines]
+"""
+
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+import generate_key
+import plot_turnout_by_age
+
+BASELINE_FILE = './engine_baselines.json'
+REGRESSION_THRESHOLD = 1.5 # runtime or peak memory above baseline * threshold is a regression.
+TIMING_REPEATS = 3 # runtime is the fastest of this many runs.
+
+FIXTURE_SEED = 20201103
+FIXTURE_COUNTIES = {'01': 2000, '02': 5000, '03': 10000} # county ID to number of voters.
+BROKEN_COUNTY = '99' # voter history without a VoterID column; every engine must count it as a failure.
+VOTING_METHODS = ['IP', 'AB', 'EI', 'PI']
+
+YEARS = sorted(plot_turnout_by_age.ELECTION_DAY)
+
+def random_date(rng: random.Random, first_year: int, last_year: int):
+    """Returns a random MM/DD/YYYY date. A few are not zero padded, as str_to_int handles those differently."""
+    month = rng.randint(1, 12)
+    day = rng.randint(1, 28)
+    year = rng.randint(first_year, last_year)
+    if rng.random() < 0.01:
+        return f'{month}/{day}/{year}'
+    return f'{month:02d}/{day:02d}/{year}'
+
+def write_fixture_county(folder: str, county_id: str, voter_count: int, rng: random.Random):
+    """Writes a registered voter and a voter history CSV file for one county, covering the quirks of the voter database."""
+    election_dates = [plot_turnout_by_age.get_election_date(year)[0] for year in YEARS]
+    voter_ids = [f'{county_id}{i:07d}' for i in range(voter_count)]
+    with open(f'{folder}/registered_voters/CTY{county_id}_vr.csv', 'w', encoding='latin-1') as f:
+        f.write('Precinct,LastName,FirstName,VoterID,Status,DateOfBirth,OriginalRegistration\n')
+        for voter_id in voter_ids:
+            x = rng.random()
+            if x < 0.01:
+                birth_date = ''
+            elif x < 0.02:
+                birth_date = str(rng.randint(1920, 2002)) # invalid, not MM/DD/YYYY.
+            else:
+                birth_date = random_date(rng, 1915, 2020) # born after early elections gives negative fractional ages.
+            x = rng.random()
+            if x < 0.1:
+                registration_date = '' # registered only if status is active.
+            else:
+                registration_date = random_date(rng, 1960, 2020) # registered after early elections.
+            status = rng.choice(['A', 'A', 'A', 'A ', 'I', 'S'])
+            f.write(f'{county_id}001,DOE,JANE,{voter_id},{status},{birth_date},{registration_date}\n')
+    with open(f'{folder}/voter_history/CTY{county_id}_vh.csv', 'w', encoding='latin-1') as f:
+        f.write('VoterID,ElectionDate,VotingMethod\n')
+        for voter_id in voter_ids:
+            for election_date in election_dates:
+                if rng.random() < 0.6:
+                    f.write(f'{voter_id},{election_date},{rng.choice(VOTING_METHODS)}\n')
+            if rng.random() < 0.3:
+                f.write(f'{voter_id},{random_date(rng, 2000, 2020)},{rng.choice(VOTING_METHODS)}\n') # other elections.
+        for i in range(voter_count // 50):
+            # votes from voters missing from the voter roll have no age.
+            f.write(f'{county_id}9{i:06d},{rng.choice(election_dates)},{rng.choice(VOTING_METHODS)}\n')
+
+def write_fixture(folder: str):
+    """Writes all fixture counties into folder, laid out like ./voter_database."""
+    os.makedirs(f'{folder}/registered_voters')
+    os.makedirs(f'{folder}/voter_history')
+    rng = random.Random(FIXTURE_SEED)
+    for county_id in FIXTURE_COUNTIES:
+        write_fixture_county(folder, county_id, FIXTURE_COUNTIES[county_id], rng)
+    shutil.copy(f'{folder}/registered_voters/CTY01_vr.csv', f'{folder}/registered_voters/CTY{BROKEN_COUNTY}_vr.csv')
+    with open(f'{folder}/voter_history/CTY{BROKEN_COUNTY}_vh.csv', 'w', encoding='latin-1') as f:
+        f.write('ElectionDate,VotingMethod\n11/03/2020,IP\n')
+
+def get_pairs(folder: str):
+    voter_files = generate_key.get_files_in_dir(f'{folder}/registered_voters')
+    vote_files = generate_key.get_files_in_dir(f'{folder}/voter_history')
+    return generate_key.pair_files(vote_files, voter_files)
+
+# Engines take the fixture folder and an election year, and return per-county (voters, votes) age histograms,
+# the number of counties that failed to parse, and the key (age to averaged normalized turnout) the engine computes.
+
+def reference_engine(folder: str, year: int):
+    """generate_key.py, which every other engine must match."""
+    election_date_str, election_date_int = plot_turnout_by_age.get_election_date(year)
+    histograms, failures = generate_key.get_age_histograms(get_pairs(folder), election_date_str, election_date_int)
+    return histograms, len(failures), generate_key.get_key(histograms)
+
+def plot_engine(folder: str, year: int):
+    """plot_turnout_by_age.py parsing the voter database directly.
+    plot_turnout_by_age.py has no aggregator of its own, so the key comes from generate_key.get_key.
+    """
+    histograms, failures = plot_turnout_by_age.get_age_histograms(get_pairs(folder), year)
+    return histograms, len(failures), generate_key.get_key(histograms)
+
+def cached_plot_engine(folder: str, year: int):
+    """plot_turnout_by_age.py writing its histogram cache, then reading it back as --render does.
+    The key comes from generate_key.get_key, as for plot_engine.
+    """
+    folders = (f'{folder}/registered_voters', f'{folder}/voter_history')
+    with tempfile.TemporaryDirectory() as histogram_folder:
+        plot_turnout_by_age.load_age_histograms(year, *folders, histogram_folder)
+        histograms, _, failures = plot_turnout_by_age.load_age_histograms(year, *folders, histogram_folder)
+    return histograms, failures, generate_key.get_key(histograms)
+
+ENGINES = {
+    'generate_key': reference_engine,
+    'plot_turnout_by_age': plot_engine,
+    'plot_turnout_by_age_cached': cached_plot_engine,
+}
+REFERENCE_ENGINE = 'generate_key'
+
+def histograms_to_str(histograms: List[Tuple[Dict[int, int], Dict[int, int]]]):
+    """Serializes histograms so that ages compare by type as well as value, e.g. 1 and 1.0 differ."""
+    return json.dumps([[sorted(voters.items()), sorted(votes.items())] for voters, votes in histograms])
+
+def run_engine(engine, folder: str):
+    """Returns a map of election year to (histograms, failures, key.json contents)."""
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for year in YEARS:
+            histograms, failures, key = engine(folder, year)
+            results[year] = (histograms_to_str(histograms), failures, json.dumps(key))
+    return results
+
+def measure_engine(engine, folder: str):
+    """Returns fastest runtime in seconds and peak traced memory in bytes of running engine over all years."""
+    runtime = None
+    for _ in range(TIMING_REPEATS):
+        start = time.perf_counter()
+        run_engine(engine, folder)
+        elapsed = time.perf_counter() - start
+        if runtime is None or elapsed < runtime:
+            runtime = elapsed
+    tracemalloc.start()
+    run_engine(engine, folder)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return runtime, peak_memory
+
+def count_active_without_registration(voter_file: str, registered_voters: Dict[str, int]):
+    """Returns the number of registered voters that have no registration date and active status."""
+    count = 0
+    with open(voter_file, 'r', encoding='latin-1') as f:
+        for row in csv.DictReader(f):
+            if row['VoterID'] in registered_voters and not row['OriginalRegistration'] and row['Status'].strip() == 'A':
+                count += 1
+    return count
+
+def check_fixture_coverage(folder: str, results: Dict[int, Tuple[str, int, str]]):
+    """Returns a list of problems if the fixture does not exercise the quirks this check is meant to cover,
+    going through the reference parser again to count the voters that take each quirk's path.
+    """
+    problems = []
+    ages = set()
+    for year in results:
+        histograms, failures, _ = results[year]
+        for voters, votes in json.loads(histograms):
+            ages.update(age for age, _ in voters)
+        if failures != 1:
+            problems.append(f'{year}: expected 1 failed county, got {failures}')
+
+        election_date_str, election_date_int = plot_turnout_by_age.get_election_date(year)
+        promoted = 0
+        active_without_registration = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for voter_file, vote_file in get_pairs(folder):
+                if os.path.basename(voter_file).startswith(f'CTY{BROKEN_COUNTY}_'):
+                    continue
+                registered_voters, all_voters = generate_key.get_registered_voters(voter_file, election_date_int)
+                active_without_registration += count_active_without_registration(voter_file, registered_voters)
+                registered_count = len(registered_voters)
+                generate_key.count_votes(vote_file, registered_voters, all_voters, election_date_str)
+                promoted += len(registered_voters) - registered_count
+        if not promoted:
+            problems.append(f'{year}: no unregistered voters promoted by their vote in fixture')
+        if not active_without_registration:
+            problems.append(f'{year}: no active voters without registration date in fixture')
+    if not any(isinstance(age, float) and age < 0 for age in ages):
+        problems.append('no negative fractional ages in fixture')
+    return problems
+
+if __name__ == '__main__':
+    update_baselines = '--update-baselines' in sys.argv[1:]
+    baselines = {}
+    if os.path.exists(BASELINE_FILE) and not update_baselines:
+        baselines = json.load(open(BASELINE_FILE, 'r'))
+    problems = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_fixture(folder)
+        reference = run_engine(ENGINES[REFERENCE_ENGINE], folder)
+        problems += check_fixture_coverage(folder, reference)
+
+        for name in ENGINES:
+            results = run_engine(ENGINES[name], folder)
+            for year in YEARS:
+                histograms, failures, key = results[year]
+                expected_histograms, expected_failures, expected_key = reference[year]
+                if histograms != expected_histograms:
+                    problems.append(f'{name}: {year} age histograms differ from {REFERENCE_ENGINE}')
+                if failures != expected_failures:
+                    problems.append(f'{name}: {year} failed counties {failures} != {expected_failures}')
+                if key != expected_key:
+                    problems.append(f'{name}: {year} key.json differs from {REFERENCE_ENGINE}')
+
+            runtime, peak_memory = measure_engine(ENGINES[name], folder)
+            print(f'{name}: runtime {runtime:.3f} s, peak memory {peak_memory / 2**20:.1f} MiB')
+            baseline = baselines.get(name)
+            if baseline is None:
+                baselines[name] = {'runtime': runtime, 'peak_memory': peak_memory}
+                print(f'{name}: recorded baseline')
+                continue
+            if runtime > baseline['runtime'] * REGRESSION_THRESHOLD:
+                problems.append(f'{name}: runtime {runtime:.3f} s regressed from baseline {baseline["runtime"]:.3f} s')
+            if peak_memory > baseline['peak_memory'] * REGRESSION_THRESHOLD:
+                problems.append(f'{name}: peak memory {peak_memory} B regressed from baseline {baseline["peak_memory"]} B')
+
+    json.dump(baselines, open(BASELINE_FILE, 'w'), indent=4)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(f'{len(problems)} problems found.')
+    print(f'all {len(ENGINES)} engines match {REFERENCE_ENGINE} within performance baselines.')
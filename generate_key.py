@@ -6,7 +6,7 @@ that can be used to predict the number of votes cast from the number of register
 
 import csv
 import os
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from matplotlib import pyplot as plt
 
 OUTPUT_FILE = './key.json'
@@ -188,39 +188,55 @@ def pair_files(files1: List[str], files2: List[str]):
         pairs.append(groups[p])
     return pairs
 
-import json
-
-if __name__ == '__main__':
-    voter_files = get_files_in_dir(REGISTERED_VOTER_FOLDER)
-    vote_files = get_files_in_dir(VOTER_HISTORY_FOLDER)
-    pairs = pair_files(vote_files, voter_files)
+def get_age_histograms(pairs: List[List[str]], election_date_str: str = "11/03/2020", election_date_int: int = 20201103):
+    """Returns a list of (voters, votes) age histograms, one per county, and the set of pairs that failed to parse.
+    'voters' maps age to number of registered voters. 'votes' maps age to number of votes.
+    """
+    histograms = []
     failures = set()
-    key = {}
-
     for p in pairs:
         print(f'processing files {p}')
         voter_file, vote_file = p
         print(voter_file)
         try:
-            registered_voters, all_voters = get_registered_voters(voter_file)
-            votes = count_votes(vote_file, registered_voters, all_voters)
+            registered_voters, all_voters = get_registered_voters(voter_file, election_date_int)
+            votes = count_votes(vote_file, registered_voters, all_voters, election_date_str)
         except Exception as e:
             failures.add(tuple(p))
             print(f'error parsing {p}: {e}')
             continue
         voters = count_registered_voters(registered_voters)
+        histograms.append((voters, votes))
+    return histograms, failures
+
+def get_key(histograms: List[Tuple[Dict[int, int], Dict[int, int]]]):
+    """Returns a map of age to normalized turnout averaged over all counties.
+    'histograms' is a list of (voters, votes) per county; 'voters' maps age to number of registered voters, 'votes' maps age to number of votes.
+    """
+    key = {}
+    for voters, votes in histograms:
         nt = get_normalized_turnout(voters, votes)
         for age in nt:
             if age not in key:
                 key[age] = []
             key[age].append(nt[age])
-    if failures:
-        print(f'could not parse {len(failures)} of {len(pairs)} counties.')
 
     for age in key:
         avg = sum(key[age]) / len(key[age])
         key[age] = avg
+    return key
+
+import json
+
+if __name__ == '__main__':
+    voter_files = get_files_in_dir(REGISTERED_VOTER_FOLDER)
+    vote_files = get_files_in_dir(VOTER_HISTORY_FOLDER)
+    pairs = pair_files(vote_files, voter_files)
+    histograms, failures = get_age_histograms(pairs)
+    if failures:
+        print(f'could not parse {len(failures)} of {len(pairs)} counties.')
+
+    key = get_key(histograms)
 
     json.dump(key, open(OUTPUT_FILE, 'w'))
     print(f'wrote key to {OUTPUT_FILE}')
-
@@ -6,12 +6,21 @@ Only the ones without birth dates are thrown out, as they cannot be grouped by a
 """
 
 import csv
+import json
 import os
-from typing import Dict
+import sys
+import tempfile
+from multiprocessing import Pool
+from typing import Dict, List
 from matplotlib import pyplot as plt
+from matplotlib import rcParams
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 
 REGISTERED_VOTER_FOLDER = './voter_database/registered_voters'
 VOTER_HISTORY_FOLDER = './voter_database/voter_history'
+HISTOGRAM_FOLDER = './histograms' # cached age histograms per election year, used by --render.
+PLOT_FOLDER = './plots'
 MINIMUM_REGISTERED_VOTERS = 50 # ages with less registered voters are not plotted.
 
 ELECTION_YEAR = 2020 # choose presidential election years from 2000 - 2020
@@ -26,13 +35,17 @@ ELECTION_DAY = {
 }
 
 ELECTION_MONTH = '11'
-ELECTION_DATE_STR = f'{ELECTION_MONTH}/{ELECTION_DAY[ELECTION_YEAR]}/{ELECTION_YEAR}'
-ELECTION_DATE_INT = int(f'{ELECTION_YEAR}{ELECTION_MONTH}{ELECTION_DAY[ELECTION_YEAR]}')
+
+def get_election_date(year: int):
+    """Returns the election date of the given presidential election year as MM/DD/YYYY string and YYYYMMDD int."""
+    return f'{ELECTION_MONTH}/{ELECTION_DAY[year]}/{year}', int(f'{year}{ELECTION_MONTH}{ELECTION_DAY[year]}')
+
+ELECTION_DATE_STR, ELECTION_DATE_INT = get_election_date(ELECTION_YEAR)
 
 def get_files_in_dir(dir_path: str):
     return [f'{dir_path}/{x}' for x in os.listdir(dir_path) if x[0] != '.'] # ignore hidden files.
 
-def count_votes(csv_file: str, registered_voters: Dict[str, int], all_voters: Dict[str, int]):
+def count_votes(csv_file: str, registered_voters: Dict[str, int], all_voters: Dict[str, int], election_date: str = ELECTION_DATE_STR):
     """Reads voter history CSV file and returns a map of age to the number of votes in the specified election.
     Expected CSV file columns: VoterID,ElectionDate,VotingMethod
     This updates registered_voters with voters from all_voters, if their vote was found, essentially assuming they were actually registered.
@@ -51,7 +64,7 @@ def count_votes(csv_file: str, registered_voters: Dict[str, int], all_voters: Di
         no_age = set()
 
         for row in csv_reader:
-            if row[ELECTION_DATE_INDEX] != ELECTION_DATE_STR:
+            if row[ELECTION_DATE_INDEX] != election_date:
                 continue
             voter_id = row[VOTER_ID_INDEX]
             age = registered_voters.get(voter_id)
@@ -102,7 +115,7 @@ def get_age(start: int, end: int):
     else:
         return int(diff / 10000)
 
-def get_registered_voters(csv_file: str):
+def get_registered_voters(csv_file: str, election_date: int = ELECTION_DATE_INT):
     """Returns a map of voter ID to age of voters registered for the specified election date.
     Expected CSV file columns:
         Precinct,LastName,FirstName,MiddleName,Suffix,
@@ -142,7 +155,7 @@ def get_registered_voters(csv_file: str):
             if not birth_date:
                 print(f'voter ID {voter_id} has invalid birth date {row[DATE_OF_BIRTH_INDEX]}')
                 continue
-            age = get_age(birth_date, ELECTION_DATE_INT)
+            age = get_age(birth_date, election_date)
 
             assert(voter_id not in all_ages)
             all_ages[voter_id] = age
@@ -151,7 +164,7 @@ def get_registered_voters(csv_file: str):
             registration_date = row[REGISTRATION_DATE_INDEX]
             if registration_date:
                 registration_date = str_to_int(registration_date)
-                if registration_date > ELECTION_DATE_INT:
+                if registration_date > election_date:
                     continue
             elif row[VOTER_STATUS_INDEX].strip() != 'A':
                 continue
@@ -163,8 +176,10 @@ def get_registered_voters(csv_file: str):
         print(f'all voters: {len(all_ages)}')
         return registered_ages, all_ages
 
-def plot_age_distribution(voters: Dict[int, int], votes: Dict[int, int]):
-    """'voters' maps age to number of registered voters. 'votes' maps age to number of votes."""
+def get_turnout_line(voters: Dict[int, int], votes: Dict[int, int]):
+    """Returns ages and normalized turnout of ages with more than MINIMUM_REGISTERED_VOTERS registered voters.
+    'voters' maps age to number of registered voters. 'votes' maps age to number of votes.
+    """
     vote_ages = set()
     for age in votes:
         vote_ages.add(age)
@@ -178,7 +193,13 @@ def plot_age_distribution(voters: Dict[int, int], votes: Dict[int, int]):
     ages = list(ages)
     ages.sort()
     overall_turnout = sum(votes) / sum(voters)
-    plt.plot([x for x in ages if voters[x] > MINIMUM_REGISTERED_VOTERS], [votes[x] / voters[x] / overall_turnout for x in ages if voters[x] > MINIMUM_REGISTERED_VOTERS])
+    x = [age for age in ages if voters[age] > MINIMUM_REGISTERED_VOTERS]
+    y = [votes[age] / voters[age] / overall_turnout for age in x]
+    return x, y
+
+def plot_age_distribution(voters: Dict[int, int], votes: Dict[int, int]):
+    """'voters' maps age to number of registered voters. 'votes' maps age to number of votes."""
+    plt.plot(*get_turnout_line(voters, votes))
 
 def pair_files(files1, files2):
     """Pairs files with common prefix before '_' together."""
@@ -204,23 +225,113 @@ def pair_files(files1, files2):
         pairs.append(groups[p])
     return pairs
 
-if __name__ == '__main__':
-    voter_files = get_files_in_dir(REGISTERED_VOTER_FOLDER)
-    vote_files = get_files_in_dir(VOTER_HISTORY_FOLDER)
-    pairs = pair_files(vote_files, voter_files)
+def get_age_histograms(pairs: List[List[str]], year: int):
+    """Returns a list of (voters, votes) age histograms, one per county, and the set of pairs that failed to parse.
+    'voters' maps age to number of registered voters. 'votes' maps age to number of votes.
+    """
+    election_date_str, election_date_int = get_election_date(year)
+    histograms = []
     failures = set()
     for p in pairs:
         print(f'processing files {p}')
         voter_file, vote_file = p
         print(voter_file)
         try:
-            registered_voters, all_voters = get_registered_voters(voter_file)
-            votes = count_votes(vote_file, registered_voters, all_voters)
+            registered_voters, all_voters = get_registered_voters(voter_file, election_date_int)
+            votes = count_votes(vote_file, registered_voters, all_voters, election_date_str)
         except Exception as e:
             failures.add(tuple(p))
             print(f'error parsing {p}: {e}')
             continue
         voters = count_registered_voters(registered_voters)
+        histograms.append((voters, votes))
+    return histograms, failures
+
+def get_file_stats(files: List[str]):
+    """Returns sorted [path, modification time, size] of files, used to tell whether cached histograms are stale."""
+    stats = []
+    for f in sorted(files):
+        stat = os.stat(f)
+        stats.append([f, stat.st_mtime, stat.st_size])
+    return stats
+
+def load_age_histograms(year: int, registered_voter_folder: str = REGISTERED_VOTER_FOLDER, voter_history_folder: str = VOTER_HISTORY_FOLDER, histogram_folder: str = HISTOGRAM_FOLDER):
+    """Returns the per-county age histograms of the given election year, the number of counties attempted, and the number of failures.
+    Histograms are cached as JSON in histogram_folder, and re-parsed when any voter database file changed since.
+    Histograms are stored as lists of [age, count] pairs, so that integer and (negative) fractional ages keep their types.
+    """
+    cache_file = f'{histogram_folder}/{year}.json'
+    voter_files = get_files_in_dir(registered_voter_folder)
+    vote_files = get_files_in_dir(voter_history_folder)
+    file_stats = get_file_stats(voter_files + vote_files)
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        if cache.get('files') == file_stats:
+            print(f'using cached histograms {cache_file}')
+            histograms = [({age: n for age, n in voters}, {age: n for age, n in votes}) for voters, votes in cache['histograms']]
+            return histograms, cache['counties'], cache['failures']
+        print(f'voter database changed since {cache_file} was written, re-parsing.')
+    pairs = pair_files(vote_files, voter_files)
+    histograms, failures = get_age_histograms(pairs, year)
+    os.makedirs(histogram_folder, exist_ok=True)
+    cache = {
+        'files': file_stats,
+        'counties': len(pairs),
+        'failures': len(failures),
+        'histograms': [[list(voters.items()), list(votes.items())] for voters, votes in histograms]
+    }
+    # write to a temporary file first, so an interrupted run never leaves a truncated cache file.
+    with tempfile.NamedTemporaryFile('w', dir=histogram_folder, suffix='.tmp', delete=False) as f:
+        json.dump(cache, f)
+    os.replace(f.name, cache_file)
+    return histograms, len(pairs), len(failures)
+
+def render_year(year: int, extension: str = 'png'):
+    """Draws all county turnout lines of the given election year to PLOT_FOLDER/YEAR.EXTENSION without a display.
+    All lines are drawn as a single line collection. Returns the output file path.
+    """
+    histograms, counties, failures = load_age_histograms(year)
+    if failures:
+        print(f'{year}: could not parse {failures} of {counties} counties.')
+    lines = [get_turnout_line(voters, votes) for voters, votes in histograms]
+    segments = [list(zip(x, y)) for x, y in lines if x]
+    colors = [c['color'] for c in rcParams['axes.prop_cycle']]
+
+    # Figure is used directly instead of pyplot, so no GUI backend is involved.
+    figure = Figure(figsize=(14.4, 8.19))
+    ax = figure.add_subplot()
+    ax.add_collection(LineCollection(segments, colors=colors))
+    ax.autoscale_view()
+    ax.set_xlabel(f'Age (less than {MINIMUM_REGISTERED_VOTERS} registered voters are hidden)')
+    ax.set_ylabel('Normalized Voter Turnout (votes / registered voters / overall turnout)')
+    ax.set_title(f'{year} Oklahoma Normalized Voter Turnout vs. Age ({counties - failures} of {counties} counties; each line = 1 county)')
+    os.makedirs(PLOT_FOLDER, exist_ok=True)
+    output_file = f'{PLOT_FOLDER}/{year}.{extension}'
+    figure.savefig(output_file)
+    print(f'wrote {output_file}')
+    return output_file
+
+def render_all(extension: str = 'png'):
+    """Renders every election year in ELECTION_DAY in parallel, one worker process per year."""
+    years = sorted(ELECTION_DAY)
+    with Pool(min(len(years), os.cpu_count() or 1)) as pool:
+        return pool.starmap(render_year, [(year, extension) for year in years])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--render':
+        # non-interactive mode: ./plot_turnout_by_age.py --render [png|svg]
+        extension = sys.argv[2] if len(sys.argv) > 2 else 'png'
+        if extension not in ('png', 'svg'):
+            sys.exit(f'unsupported output format {extension}; use png or svg.')
+        render_all(extension)
+        sys.exit()
+
+    voter_files = get_files_in_dir(REGISTERED_VOTER_FOLDER)
+    vote_files = get_files_in_dir(VOTER_HISTORY_FOLDER)
+    pairs = pair_files(vote_files, voter_files)
+    histograms, failures = get_age_histograms(pairs, ELECTION_YEAR)
+    for voters, votes in histograms:
         plot_age_distribution(voters, votes)
     if failures:
         print(f'could not parse {len(failures)} of {len(pairs)} counties.')
@@ -228,7 +339,3 @@ if __name__ == '__main__':
     plt.ylabel('Normalized Voter Turnout (votes / registered voters / overall turnout)')
     plt.title(f'{ELECTION_YEAR} Oklahoma Normalized Voter Turnout vs. Age ({len(pairs) - len(failures)} of {len(pairs)} counties; each line = 1 county)')
     plt.show()
-
-
-
-